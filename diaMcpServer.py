@@ -3,55 +3,302 @@ from __future__ import annotations
 
 # Import sys for writing diagnostic messages to stderr
 import sys
-import json
+import os
+import asyncio
+import atexit
 import time
 import io
 import base64
+import hashlib
+import math
 import tempfile
+import threading
+from collections import OrderedDict
+from collections.abc import AsyncIterator
+from contextlib import aclosing
 from pathlib import Path
 # Configure matplotlib for headless environments before importing pyplot
 import matplotlib
 matplotlib.use("Agg")
 import matplotlib.pyplot as plt
+import numpy as np
 # Import FastMCP to create the Diabetes Interface Adapter server
 from mcp.server.fastmcp import FastMCP
-import requests
+import httpx
+import ijson
+import msgspec
+import orjson
 
 # Gluroo API configuration shared across tools
 GLUROO_BASE_URL = "https://0d4e.ns.gluroo.com/api/v1"
 GLUCOSE_ENTRIES_URL = f"{GLUROO_BASE_URL}/entries.json"
+# Nightscout-style APIs accept the SHA-1 of the API secret; hash a raw secret from the
+# environment once at load, otherwise fall back to the pre-hashed default
+_GLUROO_API_SECRET = os.environ.get("GLUROO_API_SECRET")
+GLUROO_API_SECRET_SHA1 = (
+    hashlib.sha1(_GLUROO_API_SECRET.encode()).hexdigest()
+    if _GLUROO_API_SECRET
+    else "48d43ce867489ec33269f08bcc777c0ffaf57eca"
+)
 GLUROO_JSON_HEADERS = {
     "Accept": "application/json",
-    "api-secret": "48d43ce867489ec33269f08bcc777c0ffaf57eca",
+    "api-secret": GLUROO_API_SECRET_SHA1,
 }
 
+# Transient Gluroo failures that are retried with backoff instead of aborting the call
+RETRY_STATUS_CODES = frozenset({429, 502, 503, 504})
+RETRY_TOTAL = 5
+RETRY_BACKOFF_FACTOR = 0.3
+
+# Overall budget, retries included, for a single getentries call
+GETENTRIES_TIMEOUT = 10.0
+
+# Async HTTP/2 client shared by all tools so repeated calls reuse one multiplexed connection
+ASYNC_CLIENT = httpx.AsyncClient(
+    http2=True,
+    headers=GLUROO_JSON_HEADERS,
+    timeout=10.0,
+    limits=httpx.Limits(max_connections=10, max_keepalive_connections=5),
+)
+
+
+def _close_async_client() -> None:
+    asyncio.run(ASYNC_CLIENT.aclose())
+
+
+atexit.register(_close_async_client)
+
+# Minimum readings tracked for dedup per stream session (~2 weeks of 5-minute CGM data)
+STREAM_DEDUP_CAPACITY = 4096
+
+
+class Reading(msgspec.Struct):
+    """A single glucose reading returned by the streaming tools."""
+
+    sgv: int | None
+    dateString: str | None
+
+
+# Fixed-shape encoder for lists of readings
+READING_ENCODER = msgspec.json.Encoder()
+
+
+# Spacing between consecutive readings treated as a regular CGM cadence
+CGM_CADENCE_RANGE_MS = (60_000, 15 * 60_000)
+
+
+def _next_poll_delay(latest_ts: float | None, previous_ts: float | None, poll_interval: float) -> float:
+    """Seconds to wait so the next poll lands ~1s after the next expected reading.
+
+    Falls back to `poll_interval` when the cadence is unknown, irregular or the
+    reading is already overdue.
+    """
+    if latest_ts is None or previous_ts is None:
+        return poll_interval
+    cadence = latest_ts - previous_ts
+    if not CGM_CADENCE_RANGE_MS[0] <= cadence <= CGM_CADENCE_RANGE_MS[1]:
+        return poll_interval
+    wait = (latest_ts + cadence) / 1000 + 1.0 - time.time()
+    if wait <= 0:
+        return poll_interval
+    # never wait longer than one cadence, in case the server clock runs ahead of ours
+    return max(1.0, min(wait, cadence / 1000 + 1.0))
+
+
+def _retry_delay(response: httpx.Response, attempt: int) -> float:
+    """Seconds to wait before retrying, honouring a numeric `Retry-After` header."""
+    retry_after = response.headers.get("Retry-After")
+    if retry_after is not None:
+        try:
+            return max(float(retry_after), 0.0)
+        except ValueError:
+            pass
+    return RETRY_BACKOFF_FACTOR * (2 ** (attempt - 1))
+
+
+async def _send_with_retries(request: httpx.Request, deadline: float) -> httpx.Response:
+    """Send `request` as a stream, backing off on transient errors.
+
+    Retries stop after `RETRY_TOTAL` attempts or once `deadline` passes; any
+    non-success response left at that point is raised. The returned response is
+    open and must be closed by the caller.
+    """
+    for attempt in range(1, RETRY_TOTAL + 1):
+        response = await ASYNC_CLIENT.send(request, stream=True)
+        remaining = deadline - time.monotonic()
+        if response.status_code not in RETRY_STATUS_CODES or attempt == RETRY_TOTAL or remaining <= 0:
+            break
+        await response.aclose()
+        await asyncio.sleep(min(_retry_delay(response, attempt), remaining))
+        if time.monotonic() >= deadline:
+            break
+    if not response.is_success:
+        await response.aclose()
+        response.raise_for_status()
+    return response
+
+
+class _BloomFilter:
+    """Fixed-size Bloom filter for deduplicating entry ids with bounded memory."""
+
+    def __init__(self, capacity: int, error_rate: float) -> None:
+        self._size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self._hashes = max(1, round(self._size / capacity * math.log(2)))
+        self._bits = bytearray((self._size + 7) // 8)
+
+    def add(self, key: str) -> bool:
+        """Add `key`; return False if it was (probably) already present."""
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        added = False
+        for i in range(self._hashes):
+            bit = (h1 + i * h2) % self._size
+            mask = 1 << (bit & 7)
+            if not self._bits[bit >> 3] & mask:
+                self._bits[bit >> 3] |= mask
+                added = True
+        return added
+
+
+class _AsyncResponseReader:
+    """Async file-like view of a streaming httpx response for ijson."""
+
+    def __init__(self, response: httpx.Response) -> None:
+        self._chunks = response.aiter_bytes()
+
+    async def read(self, size: int = -1) -> bytes:
+        # ijson probes the return type with read(0); don't consume a chunk for it
+        if size == 0:
+            return b""
+        return await anext(self._chunks, b"")
+
+
+async def _iter_entries(response: httpx.Response) -> AsyncIterator[dict]:
+    """Yield the elements of a JSON array response as they are parsed.
+
+    Raises ValueError if the payload is not an array, e.g. an error object.
+    """
+    events = ijson.parse_async(_AsyncResponseReader(response), use_float=True)
+    first = await anext(events, None)
+    if first is None or first[1] != "start_array":
+        raise ValueError(f"Unexpected response payload: expected a JSON array, got {first[1] if first else 'an empty body'}")
+    builder = None
+    depth = 0
+    async for prefix, event, value in events:
+        if builder is None:
+            if prefix != "item":
+                continue
+            builder = ijson.ObjectBuilder()
+        builder.event(event, value)
+        if event in ("start_map", "start_array"):
+            depth += 1
+        elif event in ("end_map", "end_array"):
+            depth -= 1
+        if depth == 0:
+            yield builder.value
+            builder = None
+
+
+# Single reusable figure for plot_glucose; pyplot state is not thread-safe
+_FIG, _AX = plt.subplots(figsize=(8, 4))
+_PLOT_LOCK = threading.Lock()
+
+# Rendered plots keyed by a digest of their inputs, oldest first
+PLOT_CACHE_SIZE = 32
+_PLOT_CACHE: OrderedDict[bytes, str] = OrderedDict()
+_PLOT_CACHE_LOCK = threading.Lock()
+
+
+def _cached_glucose_plot(
+    labels: list[str],
+    values: list[float],
+    title: str,
+    y_min: float | None,
+    y_max: float | None,
+) -> str:
+    """Return the rendered plot for these inputs, rendering only on a cache miss."""
+    key = hashlib.blake2b(orjson.dumps([labels, values, title, y_min, y_max])).digest()
+    with _PLOT_CACHE_LOCK:
+        cached = _PLOT_CACHE.get(key)
+        if cached is not None:
+            _PLOT_CACHE.move_to_end(key)
+            return cached
+    encoded = _render_glucose_plot(labels, values, title, y_min, y_max)
+    with _PLOT_CACHE_LOCK:
+        _PLOT_CACHE[key] = encoded
+        _PLOT_CACHE.move_to_end(key)
+        if len(_PLOT_CACHE) > PLOT_CACHE_SIZE:
+            _PLOT_CACHE.popitem(last=False)
+    return encoded
+
+
+def _render_glucose_plot(
+    labels: list[str],
+    values: list[float],
+    title: str,
+    y_min: float | None,
+    y_max: float | None,
+) -> str:
+    """Render the glucose plot as a base64 PNG data URI."""
+    # hand Matplotlib ready-made arrays so it skips per-point list conversion
+    values_arr = np.asarray(values, dtype=np.float32)
+    x_arr = np.arange(len(labels))
+    buffer = io.BytesIO()
+    with _PLOT_LOCK:
+        _AX.clear()
+        try:
+            _AX.plot(x_arr, values_arr, marker="o", color="#1f77b4")
+            _AX.set_xticks(x_arr)
+            _AX.set_xticklabels(labels)
+            _AX.set_title(title)
+            _AX.set_xlabel("Time (India)")
+            _AX.set_ylabel("Glucose (mg/dL)")
+            if y_min is not None or y_max is not None:
+                _AX.set_ylim(bottom=y_min if y_min is not None else values_arr.min(), top=y_max if y_max is not None else values_arr.max())
+            _AX.grid(True, linestyle="--", alpha=0.4)
+            _AX.tick_params(axis="x", labelrotation=45)
+            _FIG.tight_layout()
+            # low zlib effort: encode time matters more than a few extra bytes here
+            _FIG.savefig(buffer, format="png", dpi=80, pil_kwargs={"compress_level": 1, "optimize": False})
+        finally:
+            _AX.clear()
+    # encode straight from the buffer's memory instead of copying it out first
+    with buffer.getbuffer() as png:
+        encoded = base64.b64encode(png).decode("ascii")
+    return f"data:image/png;base64,{encoded}"
+
+
 # Create a FastMCP server instance with a name
 dia = FastMCP("Dia")
 
 
 # Register the following function as a DIA tool
 @dia.tool()
-def getentries(count: int = 1) -> str:
+async def getentries(count: int = 1) -> str:
     """Fetch entries from the Gluroo API.
 
     Parameters
     - count: Number of entries to fetch (default 1)
 
+    Returns a JSON array of `{"sgv": ..., "dateString": ...}` objects.
     The API secret is managed internally for now.
     """
     try:
-        url = f"{GLUCOSE_ENTRIES_URL}?count={count}"
-        response = requests.get(url, headers=GLUROO_JSON_HEADERS, timeout=10)
-        response.raise_for_status()
-        data = response.json()
+        request = ASYNC_CLIENT.build_request("GET", GLUCOSE_ENTRIES_URL, params={"count": count})
+        response = await _send_with_retries(request, time.monotonic() + GETENTRIES_TIMEOUT)
+        try:
+            data = orjson.loads(await response.aread())
+        finally:
+            await response.aclose()
         parsed = [{"sgv": entry.get("sgv"), "dateString": entry.get("dateString")} for entry in data]
-        return str(parsed)
+        return orjson.dumps(parsed).decode()
     except Exception as e:
         return f"Error fetching entries: {e}"
 
 
 @dia.tool()
-def streamentries(
+async def streamentries(
     max_events: int = 5,
     timeout: float = 30.0,
     poll_interval: float = 5.0,
@@ -63,7 +310,7 @@ def streamentries(
     Parameters
     - max_events: Maximum number of unique readings to return (<= 0 means unlimited until timeout).
     - timeout: Total number of seconds to poll before giving up.
-    - poll_interval: Delay between REST calls while waiting for new readings.
+    - poll_interval: Delay between REST calls when the reading cadence cannot be inferred.
     - entries_url: Optional override for the Gluroo entries endpoint.
     - per_request: Optional override for `count` passed to the REST endpoint.
     """
@@ -75,50 +322,60 @@ def streamentries(
     else:
         per_request = per_request or max(limit * 2, 1)
 
-    events: list[dict] = []
-    seen_ids: set[str] = set()
+    events: list[Reading] = []
+    # size for the largest batch this call can see so the false-positive rate stays at its target
+    seen_ids = _BloomFilter(max(STREAM_DEDUP_CAPACITY, per_request, limit or 0), error_rate=1e-6)
+    latest_ts: int | None = None
+    previous_ts: int | None = None
     url = entries_url or GLUCOSE_ENTRIES_URL
     deadline = time.monotonic() + max(timeout, 0)
 
+    def record(entry: dict) -> bool:
+        """Keep `entry` if it is new; return True once the limit is reached."""
+        nonlocal latest_ts, previous_ts
+        entry_id = entry.get("_id")
+        # guards against servers that ignore the date filter
+        if entry_id is None or not seen_ids.add(entry_id):
+            return False
+        entry_date = entry.get("date")
+        if isinstance(entry_date, (int, float)):
+            # track the two newest readings to infer the sensor cadence
+            if latest_ts is None or entry_date > latest_ts:
+                previous_ts, latest_ts = latest_ts, entry_date
+            elif entry_date < latest_ts and (previous_ts is None or entry_date > previous_ts):
+                previous_ts = entry_date
+        events.append(Reading(entry.get("sgv"), entry.get("dateString")))
+        return limit is not None and len(events) >= limit
+
     try:
+        # build the poll request once (headers merged a single time) and only swap its URL per poll
+        request = ASYNC_CLIENT.build_request("GET", url)
+        base_url = request.url
         while time.monotonic() < deadline and (limit is None or len(events) < limit):
-            response = requests.get(
-                f"{url}?count={per_request}",
-                headers=GLUROO_JSON_HEADERS,
-                timeout=10,
-            )
-            response.raise_for_status()
-            data = response.json()
-            if not isinstance(data, list):
-                return f"Unexpected response payload: {data!r}"
-
-            new_found = False
-            for entry in data:
-                entry_id = entry.get("_id")
-                if entry_id is None or entry_id in seen_ids:
-                    continue
-                seen_ids.add(entry_id)
-                events.append({
-                    "sgv": entry.get("sgv"),
-                    "dateString": entry.get("dateString"),
-                    "raw": entry,
-                })
-                new_found = True
-                if limit is not None and len(events) >= limit:
-                    break
+            params: dict[str, int] = {"count": per_request}
+            if latest_ts is not None:
+                # let the server drop readings we already returned
+                params["find[date][$gt]"] = latest_ts
+            request.url = base_url.copy_merge_params(params)
+            response = await _send_with_retries(request, deadline)
+            try:
+                # parse entries as they arrive and stop reading once the limit is hit
+                async with aclosing(_iter_entries(response)) as entries:
+                    async for entry in entries:
+                        if record(entry):
+                            break
+            finally:
+                await response.aclose()
 
             if limit is not None and len(events) >= limit:
                 break
 
-            if not new_found:
-                time.sleep(max(poll_interval, 0))
-            else:
-                # brief pause to avoid hammering the endpoint when data is flowing fast
-                time.sleep(max(min(poll_interval, 1.0), 0))
+            delay = _next_poll_delay(latest_ts, previous_ts, poll_interval)
+            await asyncio.sleep(max(min(delay, deadline - time.monotonic()), 0))
     except Exception as e:
         return f"Error streaming entries via REST polling: {e}"
 
-    return json.dumps(events)
+    return READING_ENCODER.encode(events).decode()
 
 
 @dia.tool()
@@ -153,23 +410,7 @@ def plot_glucose(
     if not labels:
         return "Error: provide at least one data point."
 
-    fig, ax = plt.subplots(figsize=(8, 4))
-    ax.plot(labels, values, marker="o", color="#1f77b4")
-    ax.set_title(title)
-    ax.set_xlabel("Time (India)")
-    ax.set_ylabel("Glucose (mg/dL)")
-    if y_min is not None or y_max is not None:
-        ax.set_ylim(bottom=y_min if y_min is not None else min(values), top=y_max if y_max is not None else max(values))
-    ax.grid(True, linestyle="--", alpha=0.4)
-    plt.xticks(rotation=45)
-    plt.tight_layout()
-
-    buffer = io.BytesIO()
-    fig.savefig(buffer, format="png")
-    plt.close(fig)
-    buffer.seek(0)
-    encoded = base64.b64encode(buffer.read()).decode("ascii")
-    return f"data:image/png;base64,{encoded}"
+    return _cached_glucose_plot(list(labels), list(values), title, y_min, y_max)
 
 
 # Only run the server when this file is executed directly